@@ -1,4 +1,10 @@
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
+import tracemalloc
 import unittest
 
 from ruamel.yaml import YAML, round_trip_load
@@ -378,5 +384,679 @@ class TestMergeByType(unittest.TestCase):
                          'Merge None to list should succeed')
 
 
+class TestYamlTools(unittest.TestCase):
+    str1 = """
+#comment1
+test:
+  foo: 1 #comment1
+  bar: 1
+"""
+    str2 = """
+test:
+  bar: 2
+  baz: 3
+"""
+
+    def test_merge_and_dump(self):
+        tools = yaml_tools.YamlTools()
+        out = tools.merge(StringIO(self.str1), self.str2.encode('utf-8'))
+        expected_out = yaml_tools.successive_merge([self.str1, self.str2])
+        self.assertEqual(out, expected_out)
+        self.assertEqual(tools.dump(out), MyYAML().dump(expected_out))
+
+    def test_instance_is_reusable(self):
+        tools = yaml_tools.YamlTools()
+        for _ in range(3):
+            out = tools.dump(tools.delete(StringIO(self.str1), ['test', 'bar']))
+            self.assertEqual(out, '#comment1\ntest:\n  foo: 1 #comment1\n')
+
+    def test_load_path_and_stream(self):
+        tools = yaml_tools.YamlTools()
+        data_from_path = tools.load('./delete/file.yml')
+        with open('./delete/file.yml', 'r') as stream:
+            data_from_stream = tools.load(stream)
+        self.assertEqual(data_from_path, data_from_stream)
+        self.assertIs(tools.load(data_from_path), data_from_path)
+
+    def test_str_is_always_a_path(self):
+        tools = yaml_tools.YamlTools()
+        self.assertRaises(FileNotFoundError, tools.load, 'missing.yml')
+        self.assertRaises(FileNotFoundError, tools.merge, './delete/file.yml', 'typo.yml')
+        self.assertRaises(TypeError, tools.load, 1)
+        self.assertEqual(tools.load(text='missing.yml'), 'missing.yml')
+        self.assertEqual(tools.load(b'missing.yml'), 'missing.yml')
+        self.assertEqual(tools.dump(tools.delete(self.str1.encode('utf-8'), ['test', 'bar'])),
+                         '#comment1\ntest:\n  foo: 1 #comment1\n')
+
+    def test_comment(self):
+        tools = yaml_tools.YamlTools()
+        for _ in range(2):
+            out = tools.dump(tools.comment(StringIO(self.str1), ['test', 'foo']))
+            expected_out = yaml_tools.comment_yaml_item(round_trip_load(self.str1), ['test', 'foo'])
+            self.assertEqual(out, MyYAML().dump(expected_out))
+
+    def test_comment_with_indent(self):
+        tools = yaml_tools.YamlTools(indent=4)
+        out = tools.dump(tools.comment(b'a:\n  b:\n    c: 1\n    d: 2\n', ['a', 'b', 'c']))
+        self.assertEqual(out, 'a:\n    b:\n        #c: 1\n        d: 2\n')
+        tools = yaml_tools.YamlTools(indent=(4, 4, 2))
+        out = tools.dump(tools.comment(b'a:\n- b: 1\n  c: 2\n- d\n', ['a', '0', 'b']))
+        self.assertEqual(out, 'a:\n  -\n    #b: 1\n    c: 2\n  - d\n')
+
+    def test_dump_options(self):
+        tools = yaml_tools.YamlTools(indent=4, preserve_quotes=False)
+        out = tools.dump(tools.load(text='test:\n  foo: "bar"\n'))
+        self.assertEqual(out, 'test:\n    foo: bar\n')
+
+    def test_normalize(self):
+        tools = yaml_tools.YamlTools()
+        file = './normalize-docker-compose/file.yml'
+        out = tools.normalize(file)
+        with open(file, 'r') as stream:
+            expected_out = yaml_tools.normalize_docker_compose(stream.read())
+        self.assertEqual(out, expected_out)
+
+
+def import_times(*args, top_level=False):
+    """
+    Run the yaml-tools CLI with `python -X importtime` and report its imports
+    :param top_level: only report the modules imported by yaml-tools itself (not their own imports)
+    :return: {module: cumulative import time in us}
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '../yaml_tools.py'] + list(args),
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, module = line[len('import time:'):].split('|')
+            if top_level and module.startswith('  '):
+                continue
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative)
+    return times
+
+
+@unittest.skipIf(sys.version_info < (3, 7), '-X importtime requires python 3.7')
+class TestStartupTime(unittest.TestCase):
+    def test_help_does_not_import_ruamel(self):
+        times = import_times('--help')
+        self.assertIn('argparse', times)
+        self.assertEqual([m for m in times if m.startswith('ruamel')], [])
+
+    def test_unrecognized_command_does_not_import_ruamel(self):
+        times = import_times('super-unrecognized-command-wtf')
+        self.assertEqual([m for m in times if m.startswith('ruamel')], [])
+
+    def test_sub_command_help_does_not_import_ruamel(self):
+        times = import_times('merge', '--help')
+        self.assertEqual([m for m in times if m.startswith('ruamel')], [])
+
+    def test_sub_command_imports_ruamel(self):
+        times = import_times('merge', '-i', './merge/file1.yml', './merge/file2.yml')
+        self.assertIn('ruamel.yaml.main', times)
+
+    def test_library_import_does_not_import_ruamel(self):
+        process = subprocess.run([sys.executable, '-c', 'import sys; sys.path.insert(0, ".."); import yaml_tools; '
+                                  'print(any(m.startswith("ruamel.yaml") for m in sys.modules))'],
+                                 stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(process.stdout.strip(), 'False')
+
+    def test_startup_benchmark(self):
+        commands = [('--help',), ('merge', '--help'), ('merge', '-i', './merge/file1.yml', './merge/file2.yml')]
+        report = ['yaml-tools startup (import time of the top-level modules, best wall time of 3 runs):']
+        totals = []
+        for args in commands:
+            times = import_times(*args, top_level=True)
+            wall_times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                subprocess.run([sys.executable, '../yaml_tools.py'] + list(args), stdout=subprocess.DEVNULL)
+                wall_times.append(time.perf_counter() - start)
+            totals.append(sum(times.values()))
+            slowest = sorted(times, key=times.get, reverse=True)[:3]
+            report.append('  {0:<40} imports: {1:>6.1f}ms  wall: {2:>6.1f}ms  slowest: {3}'.format(
+                ' '.join(args)[:40], totals[-1] / 1000, min(wall_times) * 1000,
+                ', '.join('{0} ({1:.1f}ms)'.format(m, times[m] / 1000) for m in slowest)))
+        sys.stderr.write('\n' + '\n'.join(report) + '\n')
+        self.assertLess(totals[0], totals[2], '\n'.join(report))
+        self.assertLess(totals[1], totals[2], '\n'.join(report))
+
+
+class TestMergeStrategies(unittest.TestCase):
+    base = """
+    services:
+      web:
+        ports:
+          - "80:80"
+          - "443:443"
+        command: [run, --debug]
+        volumes:
+          - name: data
+            path: /data
+          - name: logs
+            path: /logs
+    """
+    overlay = """
+    services:
+      web:
+        ports:
+          - "443:443"
+          - "8080:8080"
+        command: [run, --prod]
+        volumes:
+          - name: logs
+            path: /var/logs
+          - name: cache
+            path: /cache
+    """
+
+    def merge(self, rules):
+        return yaml_tools.successive_merge([self.base, self.overlay], yaml_tools.MergeRules(rules))
+
+    def test_default_strategy(self):
+        out = self.merge({})
+        self.assertEqual(out['services']['web']['ports'], ['80:80', '443:443', '443:443', '8080:8080'])
+        self.assertEqual(len(out['services']['web']['volumes']), 4)
+
+    def test_replace(self):
+        out = self.merge({'services * command': 'replace'})
+        self.assertEqual(out['services']['web']['command'], ['run', '--prod'])
+        self.assertEqual(len(out['services']['web']['ports']), 4)
+
+    def test_unique_append(self):
+        out = self.merge({'services * ports': 'unique-append'})
+        self.assertEqual(out['services']['web']['ports'], ['80:80', '443:443', '8080:8080'])
+
+    def test_unique_append_scalar(self):
+        rules = yaml_tools.MergeRules({'test': 'unique-append'})
+        out = yaml_tools.successive_merge(['test: [1, 2]', 'test: 2'], rules)
+        self.assertEqual(out['test'], [1, 2])
+
+    def test_merge_by_key(self):
+        out = self.merge([('services * volumes', 'merge-by-key:name')])
+        expected_out = round_trip_load("""
+        - name: data
+          path: /data
+        - name: logs
+          path: /var/logs
+        - name: cache
+          path: /cache
+        """)
+        self.assertEqual(out['services']['web']['volumes'], expected_out)
+
+    def test_literal_rule_takes_precedence_over_wildcard(self):
+        out = self.merge([('services * ports', 'replace'), ('services web ports', 'unique-append')])
+        self.assertEqual(out['services']['web']['ports'], ['80:80', '443:443', '8080:8080'])
+
+    def test_invalid_strategy(self):
+        self.assertRaises(ValueError, yaml_tools.MergeRules, {'foo': 'unknown'})
+        self.assertRaises(ValueError, yaml_tools.MergeRules, {'foo': 'merge-by-key'})
+
+    def test_merge_command_with_strategy(self):
+        fo = './merge/out.yml'
+        yaml_tools.main(['merge', '-i', './merge/file1.yml', './merge/file2.yml',
+                         '-s', 'test foo', 'replace', '-o', fo])
+        with open(fo, 'r') as out_file:
+            out = round_trip_load(out_file.read())
+        self.assertEqual(out['test']['foo'], round_trip_load(open('./merge/file2.yml').read())['test']['foo'])
+        self.assertEqual(out['test']['bar'], 1)
+
+
+class TestAnchorAware(unittest.TestCase):
+    base = """
+x-common: &common
+  image: app
+  env:
+  - A=1
+services:
+  web:
+    <<: *common
+    ports: &ports
+    - 80
+  worker:
+    <<: *common
+    ports: *ports
+"""
+    overlay = """
+services:
+  web:
+    env:
+    - B=2
+    ports:
+    - 81
+"""
+
+    def test_merge_copies_shared_nodes_on_write(self):
+        out = yaml_tools.successive_merge([self.base, self.overlay], anchors=True)
+        self.assertEqual(out['x-common']['env'], ['A=1'])
+        self.assertEqual(out['services']['web']['env'], ['A=1', 'B=2'])
+        self.assertEqual(out['services']['worker']['env'], ['A=1'])
+        self.assertEqual(out['services']['web']['ports'], [80, 81])
+        self.assertEqual(out['services']['worker']['ports'], [80])
+        out_str = MyYAML().dump(out)
+        self.assertEqual(out_str.count('<<: *common'), 2)
+
+    def test_merge_keeps_src_aliases_shared(self):
+        base = """
+services:
+  web: &service
+    image: app
+  worker: *service
+"""
+        overlay = """
+services:
+  web: &extra
+    debug: true
+  worker: *extra
+"""
+        out = yaml_tools.successive_merge([base, overlay], anchors=True)
+        self.assertIs(out['services']['web'], out['services']['worker'])
+        self.assertEqual(out['services']['web'], {'image': 'app', 'debug': True})
+        out_str = MyYAML().dump(out)
+        self.assertEqual(out_str.count('debug'), 1)
+
+    def test_merge_keeps_src_merge_keys(self):
+        base = 'services:\n  web:\n    image: a\n    restart: "no"\n  db:\n    image: b\n'
+        overlay = 'x-common: &c\n  restart: always\n  logging: json\nservices:\n  web:\n    <<: *c\n' \
+                  '  db:\n    <<: *c\n    image: c\n'
+        out = yaml_tools.successive_merge([base, overlay], anchors=True)
+        out_str = MyYAML().dump(out)
+        self.assertEqual(out_str.count('logging: json'), 1)
+        self.assertEqual(out_str.count('<<: '), 2)
+        self.assertEqual(round_trip_load(out_str), yaml_tools.successive_merge([base, overlay]))
+        self.assertEqual(out['services']['web']['restart'], 'always')
+
+    def test_merge_of_shared_pair_depends_on_rules(self):
+        rules = yaml_tools.MergeRules({'x': 'unique-append'})
+        out = yaml_tools.successive_merge(['x: &l [1]\ny: *l\n', 'x: &m [1, 2]\ny: *m\n'], rules, anchors=True)
+        self.assertEqual(out['x'], [1, 2])
+        self.assertEqual(out['y'], [1, 1, 2])
+
+    def test_normalize_keeps_inherited_items_inherited(self):
+        content = """
+x-common: &common
+  labels:
+  - a=1
+  volumes: &volumes
+  - /a
+  - /a
+services:
+  web:
+    <<: *common
+    environment: &env
+    - X=1
+  worker:
+    <<: *common
+    environment: *env
+    volumes: *volumes
+"""
+        out = yaml_tools.normalize_docker_compose(content, anchors=True)
+        self.assertEqual(out['x-common']['labels'], {'a': '1'})
+        self.assertIs(out['services']['web']['environment'], out['services']['worker']['environment'])
+        self.assertEqual(out['services']['worker']['volumes'], ['/a'])
+        out_str = MyYAML().dump(out)
+        self.assertEqual(out_str.count('a: '), 1)
+        self.assertIn('environment: *env', out_str)
+
+    def test_alias_heavy_benchmark(self):
+        common = ''.join('  key{0}: value{0}\n'.format(i) for i in range(50))
+        base = 'x-common: &common\n' + common + 'services:\n' + \
+               ''.join('  s{0}:\n    <<: *common\n    name: s{0}\n'.format(i) for i in range(50))
+        overlay = 'services:\n' + ''.join('  s{0}:\n    key0: overridden\n'.format(i) for i in range(50))
+        yml = MyYAML()
+        yml.representer.ignore_aliases = lambda data: True
+        flattened = yml.dump(round_trip_load(base))
+
+        def measure(contents, anchors):
+            tracemalloc.start()
+            start = time.perf_counter()
+            out = yaml_tools.successive_merge(contents, anchors=anchors)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return out, elapsed, peak
+
+        results = [('anchors', measure([base, overlay], True)),
+                   ('default', measure([base, overlay], False)),
+                   ('flattened input', measure([flattened, overlay], False))]
+        sizes = {name: len(MyYAML().dump(out)) for name, (out, _, _) in results}
+        report = ['alias-heavy merge (load + merge):'] + [
+            '  {0:<16} output: {1:>7} chars  peak memory: {2:>8.1f}kB  time: {3:>6.1f}ms'.format(
+                name, sizes[name], peak / 1024, elapsed * 1000) for name, (_, elapsed, peak) in results]
+        sys.stderr.write('\n' + '\n'.join(report) + '\n')
+        (out, _, peak), (default_out, _, _), (flattened_out, _, flattened_peak) = [r for _, r in results]
+        self.assertEqual(out, flattened_out)
+        self.assertEqual(out, default_out)
+        self.assertLessEqual(sizes['anchors'], sizes['default'], '\n'.join(report))
+        self.assertLess(sizes['anchors'] * 10, sizes['flattened input'], '\n'.join(report))
+        self.assertLess(peak, flattened_peak, '\n'.join(report))
+
+
+class TestSchemaValidation(unittest.TestCase):
+    schema = './validate/schema.yml'
+    invalid = """
+services:
+  web:
+    ports:
+    - "80:80"
+    - 443
+"""
+
+    def test_valid(self):
+        data = round_trip_load('services:\n  web:\n    image: app\n    ports: ["80:80"]\n')
+        self.assertIs(yaml_tools.validate(data, self.schema), data)
+
+    def test_errors_path(self):
+        data = round_trip_load(self.invalid)
+        with self.assertRaises(yaml_tools.SchemaValidationError) as cm:
+            yaml_tools.validate(data, self.schema)
+        self.assertEqual(sorted(path for path, _ in cm.exception.errors),
+                         ['ROOT->services->web', 'ROOT->services->web->ports->1'])
+
+    def test_fail_fast(self):
+        data = round_trip_load(self.invalid)
+        with self.assertRaises(yaml_tools.SchemaValidationError) as cm:
+            yaml_tools.validate(data, self.schema, fail_fast=True)
+        self.assertEqual(len(cm.exception.errors), 1)
+
+    def test_anchored_booleans(self):
+        data = round_trip_load('a: &t true\nb: *t\nc: 1\n')
+        self.assertIs(yaml_tools.validate(data, {'properties': {'a': {'type': 'boolean'}, 'b': {'type': 'boolean'},
+                                                                'c': {'type': 'integer'}}}), data)
+        with self.assertRaises(yaml_tools.SchemaValidationError) as cm:
+            yaml_tools.validate(data, {'properties': {'a': {'type': 'integer'}, 'b': {'type': 'number'}}})
+        self.assertEqual(sorted(path for path, _ in cm.exception.errors), ['ROOT->a', 'ROOT->b'])
+
+    def test_compiled_schema_is_cached(self):
+        validator = yaml_tools.compile_schema(self.schema)
+        self.assertIs(yaml_tools.compile_schema('../tests/validate/schema.yml'), validator)
+        self.assertRaises(yaml_tools.SchemaValidationError, yaml_tools.YamlTools().validate,
+                          round_trip_load(self.invalid), validator)
+
+    def test_merge_command_with_schema(self):
+        with self.assertRaises(SystemExit) as cm:
+            yaml_tools.main(['merge', '-i', './merge/file1.yml', './merge/file2.yml', '-o', './merge/out.yml',
+                             '--schema', self.schema, '--fail-fast'])
+        self.assertEqual(cm.exception.code, 1)
+
+
+class TestStreamingMerge(unittest.TestCase):
+    str1 = """
+# head
+inventory:
+  hosts: # eol
+  # c0
+  - h1 # e1
+  - name: h2
+    ip: 1
+other:
+  x: 1
+"""
+    str2 = """
+other:
+  y: 2
+inventory:
+  hosts:
+  - h3 # e3
+"""
+
+    def test_same_result_as_in_memory_merge(self):
+        tools = yaml_tools.YamlTools()
+        out = StringIO()
+        tools.streaming_merge([StringIO(self.str1), StringIO(self.str2)], out, ['inventory hosts'])
+        expected_out = tools.merge(StringIO(self.str1), StringIO(self.str2))
+        self.assertEqual(round_trip_load(out.getvalue()), expected_out)
+        self.assertEqual(out.getvalue(), tools.dump(expected_out))
+        self.assertIn('  - h1 # e1\n', out.getvalue())
+
+    def test_long_paths_and_quoted_keys(self):
+        tools = yaml_tools.YamlTools()
+        long_keys = ['a_very_long_key_name_number_one', 'another_quite_long_key_name_two',
+                     'yet_another_long_key_name_three']
+        for keys in (long_keys, ['a: b', 'c d']):
+            head = ''.join('  ' * i + ("'{0}'".format(k) if ':' in k else k) + ':\n' for i, k in enumerate(keys))
+            str1 = head + '      - x # ex\n      - y\n'
+            str2 = head + '      - z # ez\n'
+            out = StringIO()
+            tools.streaming_merge([StringIO(str1), StringIO(str2)], out, [keys])
+            self.assertNotIn('yaml-tools-stream', out.getvalue())
+            self.assertEqual(out.getvalue(), tools.dump(tools.merge(StringIO(str1), StringIO(str2))))
+
+    def test_unwritten_spool(self):
+        class DroppingTools(yaml_tools.YamlTools):
+            def dump(self, data, output=None):
+                return ''.join(line for line in super(DroppingTools, self).dump(data).splitlines(True)
+                               if 'yaml-tools-stream' not in line)
+
+        self.assertRaises(RuntimeError, DroppingTools().streaming_merge, [StringIO('hosts:\n- a\n')], StringIO(),
+                          ['hosts'])
+
+    def test_root_sequence(self):
+        tools = yaml_tools.YamlTools()
+        out = StringIO()
+        tools.streaming_merge([StringIO('- 1\n- 2\n'), StringIO('- 3\n')], out, [[]])
+        self.assertEqual(out.getvalue(), '- 1\n- 2\n- 3\n')
+
+    def test_missing_and_empty_sequences(self):
+        tools = yaml_tools.YamlTools()
+        out = StringIO()
+        tools.streaming_merge([StringIO('foo: 1\n'), StringIO('hosts: []\n')], out, ['hosts'])
+        self.assertEqual(round_trip_load(out.getvalue()), {'foo': 1, 'hosts': []})
+        self.assertRaises(TypeError, tools.streaming_merge, [StringIO('hosts: 1\n')], StringIO(), ['hosts'])
+
+    def test_spool_spills_to_disk(self):
+        spool = yaml_tools.SequenceSpool(['hosts'], memory_budget=16)
+        spool.append(round_trip_load('hosts: [a, b, c, d, e, f]')['hosts'], yaml_tools.YamlTools().yaml)
+        self.assertTrue(spool.file._rolled)
+        out = StringIO()
+        spool.write_to(out)
+        spool.close()
+        self.assertEqual(out.getvalue(), '- a\n- b\n- c\n- d\n- e\n- f\n')
+
+    def test_merge_command_with_stream(self):
+        f1 = './merge/file1.yml'
+        f2 = './merge/file2.yml'
+        fo = './merge/out.yml'
+        yaml_tools.main(['merge', '-i', f1, f2, '--stream', 'test foo2 h', '--memory-budget', '64', '-o', fo])
+        with open(fo, 'r') as out_file:
+            out = round_trip_load(out_file.read())
+        self.assertEqual(out, yaml_tools.YamlTools().merge(f1, f2))
+
+
+class TestKeyPath(unittest.TestCase):
+    content = """
+test:
+  foo:
+    a: 1
+    b: 2
+    c: 3
+  bar:
+  - x: 1
+  - x: 2
+  - x: 3
+"""
+
+    def test_parse_key(self):
+        self.assertEqual([yaml_tools.parse_key(k) for k in ['0', '12', '-1', '+3', 'foo', '1a', '', 3]],
+                         [0, 12, -1, 3, 'foo', '1a', '', 3])
+        self.assertEqual(yaml_tools.KeyPath('test bar 0 x').keys, ('test', 'bar', 0, 'x'))
+        self.assertEqual(yaml_tools.KeyPath(['test', '0'], False).keys, ('test', '0'))
+
+    def test_resolve_paths_with_shared_prefix(self):
+        data = round_trip_load(self.content)
+        resolver = yaml_tools.PathResolver(data)
+        self.assertEqual(resolver.resolve('test foo a'), (data['test']['foo'], 'a'))
+        self.assertEqual(resolver.resolve('test bar 1 x'), (data['test']['bar'][1], 'x'))
+        self.assertEqual(resolver.resolve('test unknown x'), (None, 'x'))
+        self.assertEqual(list(resolver.root.children), ['test'])
+        self.assertEqual(sorted(resolver.root.children['test'].children, key=str), ['bar', 'foo'])
+        self.assertEqual(yaml_tools.resolve_paths(data, [['test', 'foo', 'b'], ['test', 'bar', '-1', 'x']]),
+                         [(data['test']['foo'], 'b'), (data['test']['bar'][2], 'x')])
+
+    def test_next_key(self):
+        data = round_trip_load(self.content)
+        resolver = yaml_tools.PathResolver(data)
+        foo = data['test']['foo']
+        self.assertEqual([resolver.next_key(foo, k) for k in 'abc'], ['b', 'c', yaml_tools.MISSING])
+        yaml_tools.delete_yaml_item(data, 'test foo b', resolver=resolver)
+        self.assertEqual(resolver.next_key(foo, 'a'), 'c')
+
+    def test_null_keys(self):
+        data = round_trip_load('m:\n  ~: 0\n  a: 1\n  b: 2\n')
+        resolver = yaml_tools.PathResolver(data)
+        yaml_tools.comment_yaml_item(data, 'm a', resolver=resolver)
+        self.assertEqual(resolver.sibling_index(data['m'])[1:], ({None: 'b'}, {'b': None}))
+
+        data = round_trip_load('m:\n  a: 1\n  ~: 0\n  b: 2\n')
+        resolver = yaml_tools.PathResolver(data)
+        self.assertIsNone(resolver.next_key(data['m'], 'a'))
+        yaml_tools.comment_yaml_item(data, 'm a', resolver=resolver)
+        self.assertEqual(MyYAML().dump(data), 'm:\n  #a: 1\n  null: 0\n  b: 2\n')
+
+    def test_delete_many_items_with_one_resolver(self):
+        paths = ['test bar 0 x', 'test bar 0', 'test bar 0 x', 'test foo a', 'test foo c']
+        expected_out = round_trip_load(self.content)
+        for path in paths:
+            yaml_tools.delete_yaml_item(expected_out, path.split())
+        out = round_trip_load(self.content)
+        resolver = yaml_tools.PathResolver(out)
+        for path in map(yaml_tools.KeyPath, paths):
+            yaml_tools.delete_yaml_item(out, path, resolver=resolver)
+        self.assertEqual(out, expected_out)
+        self.assertEqual(out, {'test': {'foo': {'b': 2}, 'bar': [{}, {'x': 3}]}})
+
+    def test_comment_many_items_with_one_resolver(self):
+        expected_out = round_trip_load(self.content)
+        yaml_tools.comment_yaml_item(expected_out, ['test', 'foo', 'b'])
+        yaml_tools.comment_yaml_item(expected_out, ['test', 'foo', 'a'])
+        out = round_trip_load(self.content)
+        resolver = yaml_tools.PathResolver(out)
+        yaml_tools.comment_yaml_item(out, ['test', 'foo', 'b'], resolver=resolver)
+        yaml_tools.comment_yaml_item(out, ['test', 'foo', 'a'], resolver=resolver)
+        yml = MyYAML()
+        self.assertEqual(yml.dump(out), yml.dump(expected_out))
+
+    def test_comment_does_not_copy_the_siblings(self):
+        class NotCopyable(yaml_tools.lazy.CommentedMap):
+            def __deepcopy__(self, memo):
+                raise AssertionError('a sibling of the commented item was copied')
+
+        for parent_key, item_key in (('foo', 'a'), ('bar', '0')):
+            data = round_trip_load(self.content)
+            parent = data['test'][parent_key]
+            if isinstance(parent, list):
+                parent.append(NotCopyable())
+            else:
+                parent['c'] = NotCopyable()
+            yaml_tools.comment_yaml_item(data, ['test', parent_key, item_key])
+
+
+class TestSplit(unittest.TestCase):
+    content = """
+services:
+  # web comment
+  web:
+    image: app # image comment
+    ports:
+    - 80
+  # db comment
+  db:
+    image: postgres
+"""
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def read(self, name):
+        with open(os.path.join(self.output_dir, name), 'r') as stream:
+            return stream.read()
+
+    def test_split_in_worker_processes(self):
+        tools = yaml_tools.YamlTools()
+        data = tools.load(text=self.content)
+        paths = tools.split(data, 'services', self.output_dir, workers=2)
+        self.assertEqual(paths, [os.path.join(self.output_dir, 'web.yml'), os.path.join(self.output_dir, 'db.yml')])
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ['db.yml', 'web.yml'])
+        self.assertIn('# image comment\n', self.read('web.yml'))
+        self.assertTrue(self.read('web.yml').startswith('# web comment\nweb:\n'))
+        self.assertNotIn('# db comment', self.read('web.yml'))
+        self.assertEqual(round_trip_load(self.read('web.yml')), {'web': data['services']['web']})
+        self.assertEqual(self.read('db.yml'), '# db comment\ndb:\n  image: postgres\n')
+
+    def test_shards_comments(self):
+        content = """
+hosts:
+# first
+- a # ea
+# before b
+- name: b
+  ip: 1 # eip
+
+# before c
+- text: |
+    c
+# before d
+- d # ed
+# after hosts
+other: 1
+"""
+        tools = yaml_tools.YamlTools()
+        data = tools.load(text=content)
+        tools.split(data, 'hosts', self.output_dir, workers=1)
+        self.assertEqual(self.read('0.yml'), '# first\n- a # ea\n')
+        self.assertEqual(self.read('1.yml'), '# before b\n- name: b\n  ip: 1 # eip\n')
+        self.assertEqual(self.read('2.yml'), '# before c\n- text: |\n    c\n')
+        self.assertEqual(self.read('3.yml'), '# before d\n- d # ed\n')
+        self.assertEqual(tools.dump(data), tools.dump(tools.load(text=content)))
+
+        content = 'services:\n  last: {}\n  # final\n\n  # other\n  other: x\n'
+        tools.split(tools.load(text=content), 'services', self.output_dir, workers=1)
+        self.assertEqual(self.read('last.yml'), 'last: {}\n')
+        self.assertEqual(self.read('other.yml'), '# final\n\n# other\nother: x\n')
+
+    @unittest.skipIf(os.name != 'posix', 'posix file modes')
+    def test_shards_mode(self):
+        tools = yaml_tools.YamlTools()
+        umask = os.umask(0o022)
+        try:
+            with open(os.path.join(self.output_dir, 'db.yml'), 'w'):
+                pass
+            os.chmod(os.path.join(self.output_dir, 'db.yml'), 0o640)
+            tools.split(tools.load(text=self.content), 'services', self.output_dir, workers=1)
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(os.path.join(self.output_dir, 'web.yml')).st_mode & 0o777, 0o644)
+        self.assertEqual(os.stat(os.path.join(self.output_dir, 'db.yml')).st_mode & 0o777, 0o640)
+
+    def test_conflicting_file_names(self):
+        tools = yaml_tools.YamlTools()
+        for content in ('a/b: 1\na_b: 2\n', "'': 1\n"):
+            self.assertRaises(ValueError, tools.split, tools.load(text=content), '', self.output_dir)
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    def test_split_in_process(self):
+        tools = yaml_tools.YamlTools()
+        tools.split(tools.load(text=self.content), 'services web ports', self.output_dir, workers=1)
+        self.assertEqual(self.read('0.yml'), '- 80\n')
+        self.assertRaises(RuntimeError, tools.split, tools.load(text=self.content), 'services unknown', self.output_dir)
+
+    def test_normalize_docker_compose_command_with_split(self):
+        content = self.content + "    environment:\n    - 'POSTGRES_USER=app'\n"
+        file = os.path.join(self.output_dir, 'docker-compose.yml')
+        with open(file, 'w') as stream:
+            stream.write(content)
+        shards_dir = os.path.join(self.output_dir, 'services')
+        yaml_tools.main(['normalize-docker-compose', '-i', file, '--split-by', 'services', '-o', shards_dir])
+        expected_out = yaml_tools.normalize_docker_compose(content)
+        self.assertEqual(sorted(os.listdir(shards_dir)), ['db.yml', 'web.yml'])
+        for k in expected_out['services']:
+            self.assertEqual(round_trip_load(self.read(os.path.join('services', k + '.yml'))),
+                             {k: expected_out['services'][k]})
+        self.assertIn('POSTGRES_USER: app', self.read('services/db.yml'))
+
+
 if __name__ == '__main__':  # pragma: no cover
     unittest.main()
@@ -1,20 +1,50 @@
 #!/usr/bin/env python3
 
 import argparse
+import itertools
+import os
 import sys
-from copy import deepcopy
-
-from ruamel.yaml import round_trip_dump, round_trip_load
-from ruamel.yaml.comments import CommentedMap, CommentedSeq
-from ruamel.yaml.error import StreamMark
-from ruamel.yaml.scalarstring import ScalarString
-from ruamel.yaml.tokens import CommentToken
 
 
 ##
 # utils
 ##
 
+class LazyImports(object):
+    """
+    Namespace of names which are imported from their module on first access (then cached as attributes),
+    so that the CLI only imports ruamel.yaml when a sub-command needs it:
+    `yaml-tools --help` or an unrecognized command don't pay the import cost
+    """
+
+    def __init__(self, **modules):
+        """
+        :param modules: module of each name, e.g. CommentedMap='ruamel.yaml.comments'
+        """
+        self._modules = modules
+
+    def __getattr__(self, name):
+        module = self.__dict__.get('_modules', {}).get(name)
+        if module is None:
+            raise AttributeError(name)
+        import importlib
+        value = getattr(importlib.import_module(module), name)
+        setattr(self, name, value)
+        return value
+
+
+lazy = LazyImports(
+    deepcopy='copy',
+    YAML='ruamel.yaml', round_trip_dump='ruamel.yaml', round_trip_load='ruamel.yaml',
+    StringIO='ruamel.yaml.compat',
+    CommentedMap='ruamel.yaml.comments', CommentedSeq='ruamel.yaml.comments', merge_attrib='ruamel.yaml.comments',
+    StreamMark='ruamel.yaml.error',
+    ScalarString='ruamel.yaml.scalarstring',
+    ScalarBoolean='ruamel.yaml.scalarbool',
+    CommentToken='ruamel.yaml.tokens',
+)
+
+
 def get_type_error(dest, src, current_path):
     return TypeError('Error trying to merge a {0} in a {1} at ({2})'.format(type(src), type(dest), current_path))
 
@@ -49,30 +79,61 @@ def is_int(s):
 # MERGE
 #
 
-def merge(dest, src, current_path=""):
+def merge(dest, src, current_path="", rules=None, anchors=None):
     """
     (Recursively) merge a source object to an dest object (CommentedMap, CommentedSeq, scalar or None)
     and append the current position to current_path
+    :param rules: MergeRules (or the MergeRuleState of the current position) giving per-path merge strategies
+    :param anchors: True (or the SharedNodes of dest and src) for an anchor-aware merge, see SharedNodes
     :return: the merged object
     """
-    if isinstance(src, CommentedMap):
-        if isinstance(dest, CommentedMap):
-            for k in src:
-                dest[k] = merge(dest[k], src[k], current_path + '->' + str(k)) if k in dest else src[k]
+    if isinstance(rules, MergeRules):
+        rules = rules.root
+    if anchors is None or anchors is False:
+        return merge_node(dest, src, current_path, rules, None)
+    if anchors is True:
+        anchors = SharedNodes(dest, src)
+    return anchors.merge(dest, src, current_path, rules)
+
+
+def merge_node(dest, src, current_path, rules, anchors):
+    """
+    Merge src to dest (without copy-on-write), see merge()
+    """
+    strategy = rules.strategy if rules is not None else None
+    if strategy == 'replace':
+        return dest if src is None else src
+
+    if isinstance(src, lazy.CommentedMap):
+        if isinstance(dest, lazy.CommentedMap):
+            keys, merge_maps = (src, None) if anchors is None else anchors.merge_keys(dest, src)
+            for k in keys:
+                if k in dest:
+                    child_rules = rules.child(k) if rules is not None else None
+                    dest[k] = merge(dest[k], src[k], current_path + '->' + str(k), child_rules, anchors)
+                else:
+                    dest[k] = src[k]
                 if k in src.ca.items and src.ca.items[k][2] and src.ca.items[k][2].value.strip():
                     # copy non empty 'items' comments
                     dest.ca.items[k] = src.ca.items[k]
+            if merge_maps:
+                dest.add_yaml_merge(merge_maps)
             copy_ca_comment_and_ca_end(dest, src)
         elif dest is None:
             return src
         else:  # scalar or CommentedSeq
             raise get_type_error(dest, src, current_path)
-    elif isinstance(src, CommentedSeq):
-        if isinstance(dest, CommentedSeq):
-            for i in src:
-                dest.append(i)
+    elif isinstance(src, lazy.CommentedSeq):
+        if isinstance(dest, lazy.CommentedSeq):
+            if strategy == 'unique-append':
+                unique_append(dest, src)
+            elif strategy == 'merge-by-key':
+                merge_by_key(dest, src, current_path, rules, anchors)
+            else:
+                for i in src:
+                    dest.append(i)
             copy_ca_comment_and_ca_end(dest, src)
-        elif isinstance(dest, CommentedMap):
+        elif isinstance(dest, lazy.CommentedMap):
             raise get_type_error(dest, src, current_path)
         elif dest is None:
             return src
@@ -82,94 +143,705 @@ def merge(dest, src, current_path=""):
     elif src is None:
         return dest
     else:  # scalar
-        if isinstance(dest, CommentedSeq):
-            dest.append(src)
-        elif isinstance(dest, CommentedMap):
+        if isinstance(dest, lazy.CommentedSeq):
+            if strategy == 'unique-append':
+                unique_append(dest, [src])
+            else:
+                dest.append(src)
+        elif isinstance(dest, lazy.CommentedMap):
             raise get_type_error(dest, src, current_path)
         else:  # scalar
             dest = src
     return dest
 
 
-def successive_merge(contents):
+def hashable_key(item):
+    """
+    :return: a hashable equivalent of a yaml item (CommentedMap, CommentedSeq or scalar), to index it
+    """
+    if isinstance(item, dict):
+        return dict, tuple((k, hashable_key(v)) for k, v in item.items())
+    if isinstance(item, list):
+        return list, tuple(hashable_key(v) for v in item)
+    return item
+
+
+def unique_append(dest, src):
+    """
+    Append the items of src which are not already in dest, using a hashed index of dest
+    """
+    index = set(hashable_key(i) for i in dest)
+    for i in src:
+        key = hashable_key(i)
+        if key not in index:
+            index.add(key)
+            dest.append(i)
+
+
+def merge_by_key(dest, src, current_path, rules, anchors=None):
+    """
+    Merge two lists of maps: the maps having the same value for rules.merge_key are merged together
+    (indexed by this value), the other items of src are appended to dest
+    """
+    key = rules.merge_key
+    index = {}
+    for i, item in enumerate(dest):
+        if isinstance(item, dict) and key in item:
+            index.setdefault(hashable_key(item[key]), i)
+    for item in src:
+        if isinstance(item, dict) and key in item:
+            item_key = hashable_key(item[key])
+            i = index.get(item_key)
+            if i is not None:
+                dest[i] = merge(dest[i], item, current_path + '->' + str(i), rules.child(i), anchors)
+                continue
+            index[item_key] = len(dest)
+        dest.append(item)
+
+
+class MergeRuleNode(object):
+    """
+    Node of the MergeRules' trie, one per path component
+    """
+    __slots__ = ('children', 'wildcard', 'strategy', 'merge_key')
+
+    def __init__(self):
+        self.children = {}
+        self.wildcard = None
+        self.strategy = None
+        self.merge_key = None
+
+
+class MergeRuleState(object):
+    """
+    State of the compiled MergeRules matcher: the set of rule nodes matching the current position.
+    Rules on literal keys take precedence over rules on wildcards
+    """
+    __slots__ = ('nodes', 'strategy', 'merge_key', 'transitions', 'wildcard')
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.strategy = None
+        self.merge_key = None
+        for node in nodes:
+            if node.strategy is not None:
+                self.strategy = node.strategy
+                self.merge_key = node.merge_key
+                break
+        self.transitions = {}
+        self.wildcard = None
+
+    def child(self, key):
+        """
+        :return: the state of the child at key (a map key or a list index), or None if no rule can match below
+        """
+        return self.transitions.get(key, self.wildcard)
+
+
+class MergeRules(object):
+    """
+    Per-path merge strategies for merge(), compiled once into a deterministic matcher (MergeRuleState)
+    which follows merge() while it recurses.
+
+    Each rule is a (path, strategy) pair, where path is a list of keys (or a space separated str, e.g. "services * ports")
+    from the root, '*' matching any key or index, and strategy is one of:
+    - deep-merge: the default behavior, maps are merged recursively and sequences are concatenated
+    - replace: the source replaces the destination
+    - append: sequences are concatenated (same as deep-merge for sequences)
+    - unique-append: only the items which are not already in the destination sequence are appended
+    - merge-by-key:KEY: in lists of maps, the maps having the same KEY value are merged (e.g. merge-by-key:name)
+    """
+    STRATEGIES = ('deep-merge', 'replace', 'append', 'unique-append', 'merge-by-key')
+
+    def __init__(self, rules):
+        """
+        :param rules: dict {path: strategy} or list of (path, strategy)
+        """
+        if isinstance(rules, dict):
+            rules = rules.items()
+        trie = MergeRuleNode()
+        for path, strategy in rules:
+            if isinstance(path, str):
+                path = list(map(parse_key, path.split()))
+            strategy, _, merge_key = strategy.partition(':')
+            if strategy not in self.STRATEGIES:
+                raise ValueError("unknown merge strategy \'{}\', expected one of {}".format(
+                    strategy, ', '.join(self.STRATEGIES)))
+            if strategy == 'merge-by-key' and not merge_key:
+                raise ValueError("the merge-by-key strategy needs a key, e.g. \'merge-by-key:name\'")
+            node = trie
+            for k in path:
+                if k == '*':
+                    if node.wildcard is None:
+                        node.wildcard = MergeRuleNode()
+                    node = node.wildcard
+                else:
+                    node = node.children.setdefault(k, MergeRuleNode())
+            node.strategy = strategy
+            node.merge_key = merge_key or None
+        self.root = self.compile((trie,), {})
+
+    def compile(self, nodes, states):
+        """
+        Build (once) the state matching the given nodes, and all the states reachable from it
+        :param states: already built states, by nodes
+        """
+        if not nodes:
+            return None
+        state_id = tuple(id(n) for n in nodes)
+        if state_id in states:
+            return states[state_id]
+        state = states[state_id] = MergeRuleState(nodes)
+        wildcards = tuple(n.wildcard for n in nodes if n.wildcard is not None)
+        for node in nodes:
+            for k in node.children:
+                if k not in state.transitions:
+                    literals = tuple(n.children[k] for n in nodes if k in n.children)
+                    state.transitions[k] = self.compile(literals + wildcards, states)
+        state.wildcard = self.compile(wildcards, states)
+        return state
+
+
+class SharedNodes(object):
+    """
+    State of an anchor-aware merge: the CommentedMap/CommentedSeq nodes which are shared, i.e. referenced more than once
+    (anchors/aliases, `<<` merge keys), or reachable from such a node.
+    merge() copies them on write, so that merging into one of their references doesn't modify the others, and merges
+    each (dest, src) pair of nodes only once, so that the nodes shared in src stay shared in the output
+    """
+
+    def __init__(self, *roots):
+        counts = {}
+        stack = list(roots)
+        while stack:
+            node = stack.pop()
+            if isinstance(node, (lazy.CommentedMap, lazy.CommentedSeq)):
+                counts[id(node)] = counts.get(id(node), 0) + 1
+                if counts[id(node)] == 1:
+                    stack.extend(child_nodes(node))
+
+        # a node reachable from a shared node is shared too (each node is visited at most once per shared flag)
+        self.shared = set()
+        visited = set()
+        stack = [(root, False) for root in roots]
+        while stack:
+            node, shared = stack.pop()
+            if not isinstance(node, (lazy.CommentedMap, lazy.CommentedSeq)):
+                continue
+            shared = shared or counts[id(node)] > 1
+            if (id(node), shared) in visited:
+                continue
+            visited.add((id(node), shared))
+            if shared:
+                self.shared.add(id(node))
+            stack.extend((child, shared) for child in child_nodes(node))
+
+        self.merged = {}
+
+    def writable(self, node):
+        """
+        :return: node itself, or a shallow copy of it if it's shared
+        """
+        return shallow_copy(node) if id(node) in self.shared else node
+
+    def merge_keys(self, dest, src):
+        """
+        Keep the `<<` merge keys of the src map: if dest has none, they're carried over to dest (so the inherited
+        items aren't copied in dest), otherwise the inherited items are merged like the others
+        :return: (the keys of src to merge in dest, the list of merge maps to add to dest once merged, or None)
+        """
+        merge_maps = getattr(src, lazy.merge_attrib, None)
+        if not merge_maps or getattr(dest, lazy.merge_attrib, None):
+            return list(src), None
+        keys = [k for k, _ in src.non_merged_items()]
+        own_keys = set(keys)
+        # the inherited items overriding an item of dest are still merged
+        keys.extend(k for k, _ in dest.non_merged_items() if k in src and k not in own_keys)
+        return keys, list(merge_maps)
+
+    def merge(self, dest, src, current_path, rules):
+        """
+        Copy-on-write and memoized merge_node(), a (dest, src) pair being merged once per MergeRuleState
+        """
+        key = (id(dest), id(src), id(rules))
+        if key in self.merged:
+            return self.merged[key][2]
+        original_dest, original_src = dest, src
+        if src is not None and isinstance(dest, (lazy.CommentedMap, lazy.CommentedSeq)):
+            dest = self.writable(dest)
+        elif isinstance(src, lazy.CommentedSeq) and dest is not None:
+            src = self.writable(src)  # the scalar dest is appended to src
+        result = merge_node(dest, src, current_path, rules, self)
+        # keep a reference on the original nodes (the rules states are kept by their MergeRules),
+        # so that their ids can't be reused
+        self.merged[key] = (original_dest, original_src, result)
+        return result
+
+
+def child_nodes(node):
+    """
+    :return: the values of a CommentedMap (without the inherited ones) and the maps it inherits from,
+    or the items of a CommentedSeq
+    """
+    if isinstance(node, lazy.CommentedMap):
+        return [v for _, v in node.non_merged_items()] + [m for _, m in getattr(node, lazy.merge_attrib, [])]
+    return list(node)
+
+
+def shallow_copy(node):
+    """
+    Copy a CommentedMap/CommentedSeq and its comments, but neither its anchor nor its children.
+    The `<<` merge keys are kept, so that the inherited items stay inherited
+    """
+    if isinstance(node, lazy.CommentedMap):
+        copied = lazy.CommentedMap()
+        for k, v in node.non_merged_items():
+            copied[k] = v
+        if getattr(node, lazy.merge_attrib, None):
+            copied.add_yaml_merge(list(getattr(node, lazy.merge_attrib)))
+    else:
+        copied = lazy.CommentedSeq(node)
+    if node.ca.comment is not None:
+        copied.ca.comment = list(node.ca.comment)
+    copied.ca.items.update(node.ca.items)
+    copied.ca.end = list(node.ca.end)
+    if node.fa.flow_style():
+        copied.fa.set_flow_style()
+    return copied
+
+
+def successive_merge(contents, rules=None, anchors=False):
     """
     Successively merge a list of yaml contents by calling merge()
     :param contents: list of yaml contents in str format
+    :param rules: optional MergeRules
+    :param anchors: anchor-aware merge, see SharedNodes
     :return: merged yaml in str format
     """
     data = []
     for i in contents:
-        data.append(round_trip_load(i, preserve_quotes=True))
-    for i in range(-1, -len(contents), -1):
-        final_data = merge(data[i - 1], data[i], 'ROOT')
+        data.append(lazy.round_trip_load(i, preserve_quotes=True))
+    return successive_merge_data(data, rules, anchors)
+
+
+def successive_merge_data(data, rules=None, anchors=False):
+    """
+    Successively merge a list of already loaded yaml data by calling merge(), from the last to the first
+    :param data: list of yaml data (CommentedMap, CommentedSeq, scalar or None)
+    :param rules: optional MergeRules
+    :param anchors: anchor-aware merge, see SharedNodes
+    :return: merged yaml data
+    """
+    final_data = data[-1]
+    for i in range(-2, -len(data) - 1, -1):
+        final_data = merge(data[i], final_data, 'ROOT', rules, anchors)
     return final_data
 
 
 ##
-# DELETE and COMMENT
+# STREAMING MERGE
+##
+
+# default memory budget of a SequenceSpool, before it spills to a temporary file
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+
+
+class SkipLines(object):
+    """
+    Writable stream wrapper which skips the first lines written to it
+    """
+    # ruamel.yaml writes bytes in the streams without encoding
+    encoding = 'utf-8'
+
+    def __init__(self, stream, lines):
+        self.stream = stream
+        self.lines = lines
+
+    def write(self, s):
+        while self.lines > 0 and s:
+            i = s.find('\n')
+            if i < 0:
+                return
+            s = s[i + 1:]
+            self.lines -= 1
+        if s:
+            self.stream.write(s)
+
+
+class SequenceSpool(object):
+    """
+    The items of a streamed sequence, dumped progressively in a temporary file
+    which stays in memory until it exceeds memory_budget, then spills to disk.
+    Like merge() does, only the items of the first appended sequence keep their comments
+    """
+    # numbers of the markers, which are short and plain scalars so that the dumper never wraps nor quotes them
+    marker_numbers = itertools.count()
+
+    def __init__(self, path, memory_budget=DEFAULT_MEMORY_BUDGET):
+        import tempfile
+        self.path = path
+        self.count = 0
+        self.appended = False
+        self.file = tempfile.SpooledTemporaryFile(max_size=memory_budget, mode='w+', encoding='utf-8')
+        self.marker = 'yaml-tools-stream-{0}'.format(next(self.marker_numbers))
+
+    def append(self, seq, yaml):
+        """
+        Dump the items of seq at the end of the spool, indented as they are in the document
+        :param yaml: the YAML() instance dumping the document
+        """
+        chunk = lazy.CommentedSeq(seq)
+        if not self.appended:
+            chunk.ca.items.update(seq.ca.items)
+        self.appended = True
+        chunk.fa.set_block_style()
+        skeleton = chunk
+        for k in reversed(self.path):
+            skeleton = lazy.CommentedMap([(k, skeleton)])
+        yaml.dump(skeleton, SkipLines(self.file, len(self.path)))
+        self.count += len(seq)
+
+    def write_to(self, stream):
+        import shutil
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, stream)
+
+    def close(self):
+        self.file.close()
+
+
+def detach_sequence(data, path, current_path='ROOT'):
+    """
+    Replace the sequence at path (list of map keys) by an empty placeholder, which keeps its own comments
+    :return: (data, the detached sequence or None if there is no item at path)
+    """
+    parent = None
+    node = data
+    for k in path:
+        if not isinstance(node, lazy.CommentedMap):
+            raise get_type_error(node, lazy.CommentedSeq(), current_path)
+        if k not in node:
+            return data, None
+        parent, node = node, node[k]
+        current_path += '->' + str(k)
+    if node is None:
+        return data, None
+    if not isinstance(node, lazy.CommentedSeq):
+        raise TypeError('Error trying to stream a {0} at ({1}), only sequences can be streamed'.format(
+            type(node), current_path))
+    placeholder = lazy.CommentedSeq()
+    copy_ca_comment_and_ca_end(placeholder, node)
+    if parent is None:
+        return placeholder, node
+    parent[path[-1]] = placeholder
+    return data, node
+
+
+def streaming_merge(sources, output, paths, rules=None, anchors=False, memory_budget=DEFAULT_MEMORY_BUDGET, tools=None):
+    """
+    Merge the sources like successive_merge(), then write the result in output, but the sequences at the given paths
+    are streamed: they're detached from each source as soon as it's loaded, their items are spooled
+    (see SequenceSpool) and only written back when the output is written, so the merged sequences are never
+    built in memory. The streamed sequences are always concatenated (the rules don't apply to them), in block style.
+    :param sources: list of sources (see YamlTools)
+    :param output: path or writable stream
+    :param paths: list of paths (list of map keys, or space separated str) to the streamed sequences
+    :param memory_budget: size (in bytes) above which each spool is spilled to disk
+    :param tools: YamlTools used to load the sources and dump the output
+    """
+    tools = tools or YamlTools()
+    paths = [p.split() if isinstance(p, str) else list(p) for p in paths]
+    spools = [SequenceSpool(p, memory_budget) for p in paths]
+    try:
+        data = []
+        for source in sources:
+            item = tools.load(source)
+            for spool in spools:
+                item, seq = detach_sequence(item, spool.path)
+                if seq is not None:
+                    spool.append(seq, tools.yaml)
+            data.append(item)
+        final_data = successive_merge_data(data, rules, anchors)
+
+        markers = {}
+        for spool in spools:
+            if spool.count > 0:
+                placeholder = final_data.mlget(spool.path) if spool.path else final_data
+                if not isinstance(placeholder, lazy.CommentedSeq):
+                    raise RuntimeError("Couldn't reach the streamed sequence following the path " + str(spool.path))
+                placeholder.append(spool.marker)
+                placeholder.fa.set_block_style()
+                markers[spool.marker] = spool
+
+        skeleton = tools.dump(final_data)
+        stream = open(output, 'w') if isinstance(output, (str, os.PathLike)) else output
+        try:
+            for line in skeleton.splitlines(True):
+                item = line.strip()
+                spool = markers.pop(item[1:].strip(), None) if item.startswith('-') else None
+                if spool is None:
+                    stream.write(line)
+                else:
+                    spool.write_to(stream)
+        finally:
+            if stream is not output:
+                stream.close()
+        if markers:
+            raise RuntimeError("Couldn't write the streamed sequences following the paths " +
+                               ', '.join(str(spool.path) for spool in markers.values()))
+    finally:
+        for spool in spools:
+            spool.close()
+
+
 ##
+# PATHS
+##
+
+def parse_key(s):
+    """
+    Same as str_or_int_map(), without try/except: parse a path component to an int if it's an integer
+    """
+    if isinstance(s, str) and (s.isdecimal() or (s[:1] in ('-', '+') and s[1:].isdecimal())):
+        return int(s)
+    return s
+
+
+class KeyPath(object):
+    """
+    A path_to_key (e.g. [foo 0 bar] or "foo 0 bar") parsed once, to be resolved by a PathResolver
+    """
+    __slots__ = ('keys', 'parent_keys', 'key')
+
+    def __init__(self, path_to_key, data_contains_list=True):
+        """
+        :param data_contains_list: parse the integer components to int, to access list items
+        """
+        if isinstance(path_to_key, str):
+            path_to_key = path_to_key.split()
+        self.keys = tuple(map(parse_key, path_to_key)) if data_contains_list else tuple(path_to_key)
+        self.parent_keys = self.keys[:-1]
+        self.key = self.keys[-1]
+
+    def __repr__(self):
+        return str(list(self.keys))
+
+
+# returned by child_item() when the child can't be reached
+MISSING = object()
+
+
+def child_item(node, key):
+    """
+    :return: node[key] if node is a map containing key or a list containing the index key, MISSING otherwise
+    """
+    if isinstance(node, dict):
+        return node[key] if key in node else MISSING
+    if isinstance(node, list) and isinstance(key, int) and -len(node) <= key < len(node):
+        return node[key]
+    return MISSING
+
+
+class PathCacheNode(object):
+    """
+    Node of the PathResolver cache: a resolved yaml node and the cache nodes of its resolved children, by key
+    """
+    __slots__ = ('node', 'children')
+
+    def __init__(self, node):
+        self.node = node
+        self.children = {}
+
 
-def delete_yaml_item(data, path_to_key, data_contains_list=True):
+class PathResolver(object):
     """
-    Delete a yaml item given its path_to_key (e.g. [foo 0 bar]), and its direct previous comment(s)
+    Resolve many KeyPaths against the same document: the resolved nodes are cached in a trie, so the paths sharing
+    a prefix only resolve it once, and the successor of each key in a map is indexed (see next_key()).
+    The document must only be modified through delete_yaml_item()/comment_yaml_item() called with this resolver
+    (or removed() must be called), otherwise the cache becomes stale.
     """
-    if data_contains_list:
-        path_to_key = list(map(str_or_int_map, path_to_key))
 
-    parent = data.mlget(path_to_key[:-1], list_ok=data_contains_list) if len(path_to_key) > 1 else data
-    item_key = path_to_key[-1]
+    def __init__(self, data):
+        self.root = PathCacheNode(data)
+        # id(map) -> (map, {key: next key}, {key: previous key})
+        self.sibling_indexes = {}
+
+    def resolve_cache_node(self, path):
+        """
+        :return: the cache node of the parent of the item at path, or None if it can't be reached
+        """
+        cache_node = self.root
+        for k in path.parent_keys:
+            child = cache_node.children.get(k)
+            if child is None:
+                node = child_item(cache_node.node, k)
+                if node is MISSING:
+                    return None
+                child = cache_node.children[k] = PathCacheNode(node)
+            cache_node = child
+        return cache_node
+
+    def resolve(self, path):
+        """
+        :param path: KeyPath, or path_to_key
+        :return: (parent, key) of the item at path, parent being None if it can't be reached
+        """
+        if not isinstance(path, KeyPath):
+            path = KeyPath(path)
+        cache_node = self.resolve_cache_node(path)
+        return (cache_node.node if cache_node is not None else None), path.key
+
+    def sibling_index(self, parent):
+        if id(parent) not in self.sibling_indexes:
+            keys = list(parent.keys())
+            self.sibling_indexes[id(parent)] = (parent, dict(zip(keys, keys[1:])), dict(zip(keys[1:], keys)))
+        return self.sibling_indexes[id(parent)]
+
+    def next_key(self, parent, key):
+        """
+        :return: the key following key in the map parent, or MISSING if it's the last one (a key can be None)
+        """
+        return self.sibling_index(parent)[1].get(key, MISSING)
+
+    def removed(self, cache_node, key):
+        """
+        Update the cache after the item at key has been removed from cache_node.node
+        """
+        parent = cache_node.node
+        if isinstance(parent, dict):
+            cache_node.children.pop(key, None)
+            if id(parent) in self.sibling_indexes:
+                _, next_keys, previous_keys = self.sibling_indexes[id(parent)]
+                next_k = next_keys.pop(key, MISSING)
+                previous_k = previous_keys.pop(key, MISSING)
+                if previous_k is not MISSING:
+                    if next_k is not MISSING:
+                        next_keys[previous_k] = next_k
+                    else:
+                        del next_keys[previous_k]
+                if next_k is not MISSING:
+                    if previous_k is not MISSING:
+                        previous_keys[next_k] = previous_k
+                    else:
+                        del previous_keys[next_k]
+        else:  # the next items are shifted
+            cache_node.children.clear()
+
+
+def resolve_paths(data, paths, data_contains_list=True):
+    """
+    Resolve many paths against the same document, resolving their shared prefixes once
+    :param paths: list of KeyPath or path_to_key
+    :return: list of (parent, key), parent being None if it can't be reached
+    """
+    resolver = PathResolver(data)
+    return [resolver.resolve(p if isinstance(p, KeyPath) else KeyPath(p, data_contains_list)) for p in paths]
 
-    if isinstance(parent, CommentedMap):
+
+##
+# DELETE and COMMENT
+##
+
+def delete_yaml_item(data, path_to_key, data_contains_list=True, resolver=None):
+    """
+    Delete a yaml item given its path_to_key (e.g. [foo 0 bar], or a KeyPath), and its direct previous comment(s)
+    :param resolver: PathResolver of data, to delete many items
+    """
+    path = path_to_key if isinstance(path_to_key, KeyPath) else KeyPath(path_to_key, data_contains_list)
+    resolver = resolver or PathResolver(data)
+    cache_node = resolver.resolve_cache_node(path)
+    parent = cache_node.node if cache_node is not None else None
+    item_key = path.key
+
+    if isinstance(parent, lazy.CommentedMap):
         if item_key not in parent:
             raise KeyError("the key \'{}\' does not exist".format(item_key))
         preceding_comments = parent.ca.items.get(item_key, [None, None, None, None])[1]
         del parent[item_key]
-    elif isinstance(parent, CommentedSeq):
-        if not is_int(item_key) or item_key >= len(parent):
+    elif isinstance(parent, lazy.CommentedSeq):
+        if not isinstance(item_key, int) or item_key >= len(parent):
             raise RuntimeError("the key \'{}\' is not an integer or exceeds its parent's length".format(item_key))
         else:
-            preceding_comments = deepcopy(parent.ca.items.get(item_key, [None, None, None, None])[1])
+            preceding_comments = lazy.deepcopy(parent.ca.items.get(item_key, [None, None, None, None])[1])
             parent.pop(item_key)  # CommentedSet.pop(idx) automatically shifts all ca.items' indexes !
     else:
-        raise RuntimeError("Couldn't reach the last item following the path_to_key " + str(path_to_key))
+        raise RuntimeError("Couldn't reach the last item following the path_to_key " + str(path))
 
+    resolver.removed(cache_node, item_key)
     return data, preceding_comments
 
 
-def comment_yaml_item(data, path_to_key, data_contains_list=True):
+def commented_copy(parent, key):
+    """
+    :return: a copy of parent only containing (a copy of) parent[key], with its comments and the parent's ones,
+    without copying the other items
     """
-    (EXPERIMENTAL) Comment a yaml item given its path_to_key (e.g. [foo 0 bar]), with comment preservation
+    if isinstance(parent, lazy.CommentedMap):
+        copied = lazy.CommentedMap()
+        copied[key] = lazy.deepcopy(parent[key])
+        copied_key = key
+    else:
+        copied = lazy.CommentedSeq([lazy.deepcopy(parent[key])])
+        copied_key = 0
+    if key in parent.ca.items:
+        copied.ca.items[copied_key] = lazy.deepcopy(parent.ca.items[key])
+    copied.ca.comment = lazy.deepcopy(parent.ca.comment)
+    copied.ca.end = lazy.deepcopy(parent.ca.end)
+    if parent.fa.flow_style():
+        copied.fa.set_flow_style()
+    return copied
+
+
+def comment_column(data, path, yaml=None):
+    """
+    :param path: KeyPath of an item
+    :param yaml: YAML() instance dumping data, or None for round_trip_dump()
+    :return: the column of the lines of the commented item once dumped: the column of the keys of its parent map,
+    or of the key of its parent sequence (the dumped item starting with the dash offset)
+    """
+    map_indent = getattr(yaml, 'map_indent', None) or 2
+    sequence_indent = getattr(yaml, 'sequence_indent', None) or 2
+    column = 0
+    node = data
+    for k in path.parent_keys:
+        child = node[k]
+        if isinstance(node, lazy.CommentedSeq):
+            column += sequence_indent
+        elif isinstance(child, lazy.CommentedMap):
+            column += map_indent
+        node = child
+    return column
+
+
+def comment_yaml_item(data, path_to_key, data_contains_list=True, resolver=None, yaml=None):
+    """
+    (EXPERIMENTAL) Comment a yaml item given its path_to_key (e.g. [foo 0 bar], or a KeyPath),
+    with comment preservation
     Inspired from https://stackoverflow.com/a/43927974 @cherrot
+    :param resolver: PathResolver of data, to comment many items
+    :param yaml: YAML() instance dumping the commented item, instead of a new round_trip_dump() dumper on each call
     """
-    if data_contains_list:
-        path_to_key = list(map(str_or_int_map, path_to_key))
-
-    parent = data.mlget(path_to_key[:-1], list_ok=data_contains_list) if len(path_to_key) > 1 else data
-    item_key = path_to_key[-1]
+    path = path_to_key if isinstance(path_to_key, KeyPath) else KeyPath(path_to_key, data_contains_list)
+    resolver = resolver or PathResolver(data)
+    cache_node = resolver.resolve_cache_node(path)
+    parent = cache_node.node if cache_node is not None else None
+    item_key = path.key
     deleted_item = item_key
 
     next_key = None
 
-    if isinstance(parent, CommentedMap):
+    if isinstance(parent, lazy.CommentedMap):
         if item_key not in parent:
             raise KeyError("the key \'{}\' does not exist".format(item_key))
         # don't just pop the value for item_key that way you lose comments
-        # in the original YAML, instead deepcopy and delete what is not needed
-        block_copy = deepcopy(parent)
-        found = False
-        keys = [k for k in parent.keys()]
-        for key in reversed(keys):
-            if key == item_key:
-                found = True
-            else:
-                if not found:
-                    next_key = key
-                del block_copy[key]
+        # in the original YAML, instead copy the item with its comments
+        block_copy = commented_copy(parent, item_key)
+        next_key = resolver.next_key(parent, item_key)
 
         # now delete the key and its value, but preserve its preceding comments
         preceding_comments = parent.ca.items.get(item_key, [None, None, None, None])[1]
 
-        if next_key is None:
+        if next_key is MISSING:
             if parent.ca.comment is None:
                 parent.ca.comment = [None, []]
             if parent.ca.comment[1] is None:
@@ -184,17 +856,14 @@ def comment_yaml_item(data, path_to_key, data_contains_list=True):
             for c in reversed(preceding_comments):
                 comment_list.insert(0, c)
         del parent[item_key]
-    elif isinstance(parent, CommentedSeq):
-        if not is_int(item_key) or item_key >= len(parent):
+    elif isinstance(parent, lazy.CommentedSeq):
+        if not isinstance(item_key, int) or item_key >= len(parent):
             raise RuntimeError("the key \'{}\' is not an integer or exceeds its parent's length".format(item_key))
         else:
-            block_copy = deepcopy(parent)
-            for i in reversed(range(len(parent))):
-                if i != item_key:
-                    del block_copy[i]
+            block_copy = commented_copy(parent, item_key)
 
             next_key = item_key
-            preceding_comments = deepcopy(parent.ca.items.get(item_key, [None, None, None, None])[1])
+            preceding_comments = lazy.deepcopy(parent.ca.items.get(item_key, [None, None, None, None])[1])
             parent.pop(item_key)  # CommentedSet.pop(idx) automatically shifts all ca.items' indexes !
 
             if len(parent) == 1 or next_key == len(parent):
@@ -209,22 +878,26 @@ def comment_yaml_item(data, path_to_key, data_contains_list=True):
                 for c in reversed(preceding_comments):
                     comment_list.insert(0, c)
     else:
-        raise RuntimeError("Couldn't reach the last item following the path_to_key " + str(path_to_key))
+        raise RuntimeError("Couldn't reach the last item following the path_to_key " + str(path))
+    resolver.removed(cache_node, item_key)
 
-    key_dept = len(path_to_key) - 1
-    if is_int(path_to_key[-1]) and key_dept > 0:
-        key_dept = key_dept - 1
-    comment_list_copy = deepcopy(comment_list)
+    comment_list_copy = lazy.deepcopy(comment_list)
     del comment_list[:]
 
-    start_mark = StreamMark(None, None, None, 2 * key_dept)
+    start_mark = lazy.StreamMark(None, None, None, comment_column(data, path, yaml))
     skip = True
-    for line in round_trip_dump(block_copy).splitlines(True):
+    if yaml is None:
+        dumped = lazy.round_trip_dump(block_copy)
+    else:
+        stream = lazy.StringIO()
+        yaml.dump(block_copy, stream)
+        dumped = stream.getvalue()
+    for line in dumped.splitlines(True):
         if skip:
             if line.strip(' ').startswith('#'):  # and deleted_item not in line:
                 continue
             skip = False
-        comment_list.append(CommentToken('#' + line, start_mark, None))
+        comment_list.append(lazy.CommentToken('#' + line, start_mark, None))
     comment_list.extend(comment_list_copy)
 
     return data
@@ -235,15 +908,15 @@ def comment_yaml_item(data, path_to_key, data_contains_list=True):
 ##
 
 def is_str_dict(s):
-    return isinstance(s, (str, ScalarString)) and ('=' in s or ':' in s)
+    return isinstance(s, (str, lazy.ScalarString)) and ('=' in s or ':' in s)
 
 
 def only_contains_str_dict(data):
-    if isinstance(data, CommentedMap):
+    if isinstance(data, lazy.CommentedMap):
         for k in data:
             if not is_str_dict(data[k]):
                 return False
-    elif isinstance(data, CommentedSeq):
+    elif isinstance(data, lazy.CommentedSeq):
         for v in data:
             if not is_str_dict(v):
                 return False
@@ -275,8 +948,8 @@ def convert_commented_seq_to_dict(seq):
     :return: CommentedMap|CommentedSeq
     """
     if len(seq) > 0 and only_contains_str_dict(seq):
-        seq_copy = deepcopy(seq)
-        data = CommentedMap()
+        seq_copy = lazy.deepcopy(seq)
+        data = lazy.CommentedMap()
         copy_ca_comment_and_ca_end(data, seq_copy)
         for i in range(len(seq_copy)):
             k, v = convert_str_to_key_value(seq_copy[i])
@@ -294,7 +967,7 @@ def delete_duplicated_items(service, key):
     :param key: key to an array
     :return: service
     """
-    if key in service and isinstance(service[key], CommentedSeq):
+    if key in service and isinstance(service[key], lazy.CommentedSeq):
         array = service[key]
         del_indexes = set()
         i1 = -1
@@ -310,59 +983,529 @@ def delete_duplicated_items(service, key):
     return service
 
 
-def normalize_docker_compose(content):
+def owner_of(data, key):
+    """
+    :return: the CommentedMap owning data[key], i.e. data itself or the map it's inherited from through `<<` merge keys
+    """
+    if any(k == key for k, _ in data.non_merged_items()):
+        return data
+    for _, merged in getattr(data, lazy.merge_attrib, []):
+        if key in merged:
+            return owner_of(merged, key)
+    return data
+
+
+def set_owned_item(data, key, value):
+    """
+    Set data[key] in the map owning it (see owner_of()), so that an inherited item stays inherited
+    """
+    owner = owner_of(data, key)
+    owner[key] = value
+    # some ruamel.yaml versions copy the inherited items in the maps having a `<<` merge key
+    for referer in getattr(owner, '_ref', []):
+        referer.update_key_value(key)
+
+
+def normalize_service(service, normalized=None):
+    """
+    Normalize one docker-compose service, see normalize_docker_compose()
+    :param normalized: None, or a dict of the already normalized nodes (by id) for an anchor-aware normalization:
+    each shared node (anchor/alias) is only normalized once and stays shared, and the items inherited through
+    `<<` merge keys are normalized in the map they're inherited from, instead of being expanded in each service
+    """
+    for key in ('labels', 'environment'):
+        if key in service and isinstance(service[key], lazy.CommentedSeq):
+            if normalized is None:
+                service[key] = convert_commented_seq_to_dict(service[key])
+                continue
+            seq = service[key]
+            if id(seq) not in normalized:
+                data = convert_commented_seq_to_dict(seq)
+                if data is not seq and seq.anchor.value is not None:
+                    data.yaml_set_anchor(seq.anchor.value, always_dump=seq.anchor.always_dump)
+                normalized[id(seq)] = (seq, data)
+            set_owned_item(service, key, normalized[id(seq)][1])
+    for key in ('volumes', 'env_file'):
+        if normalized is not None and key in service:
+            if id(service[key]) in normalized:
+                continue
+            normalized[id(service[key])] = (service[key], service[key])
+        delete_duplicated_items(service, key)
+    return service
+
+
+def normalize_docker_compose(content, anchors=False):
     """
     If content is a CommentedMap, convert all key-value string (e.g. 'foo=bar' or '80:8080')
     to key-value dicts inside the services' `labels` and `environment` fields,
     also delete all duplicated volumes and env_file (and its preceding comments) for each services
+    :param anchors: anchor-aware normalization, see normalize_service()
+    """
+    return normalize_docker_compose_data(lazy.round_trip_load(content, preserve_quotes=True), anchors)
+
+
+def normalize_docker_compose_data(data, anchors=False):
     """
-    data = round_trip_load(content, preserve_quotes=True)
-    if isinstance(data, CommentedMap):
+    Same as normalize_docker_compose(), but on already loaded yaml data (which is modified in place)
+    """
+    if isinstance(data, lazy.CommentedMap):
         keys = [key.lower() for key in data.keys()]
         if 'services' in keys:
             services = data['services']
+            normalized = {} if anchors else None
             for k in services:
-                if 'labels' in services[k] and isinstance(services[k]['labels'], CommentedSeq):
-                    services[k]['labels'] = convert_commented_seq_to_dict(services[k]['labels'])
-                if 'environment' in services[k] and isinstance(services[k]['environment'], CommentedSeq):
-                    services[k]['environment'] = convert_commented_seq_to_dict(services[k]['environment'])
-                delete_duplicated_items(services[k], 'volumes')
-                delete_duplicated_items(services[k], 'env_file')
+                if anchors:
+                    if id(services[k]) in normalized:
+                        continue
+                    normalized[id(services[k])] = (services[k], services[k])
+                normalize_service(services[k], normalized)
+    return data
+
+
+##
+# VALIDATE
+##
+
+class SchemaValidationError(ValueError):
+    """
+    Raised by validate(), errors is the list of (path, message), the path being in the 'ROOT->a->b' format
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(SchemaValidationError, self).__init__(
+            'Schema validation failed:\n' + '\n'.join('{0}: {1}'.format(path, message) for path, message in errors))
+
+
+# compiled schema validators, by schema path
+schema_validators = {}
+
+
+def compile_schema(schema):
+    """
+    Check and compile a JSON schema (requires the jsonschema package)
+    :param schema: path to a JSON schema (in json or yaml format), or the schema itself (dict).
+    The compiled validators of the schema paths are cached in schema_validators
+    :return: the compiled validator
+    """
+    if isinstance(schema, (str, os.PathLike)):
+        path = os.path.abspath(schema)
+        if path not in schema_validators:
+            with open(path, 'r') as stream:
+                schema_validators[path] = compile_schema(lazy.YAML(typ='safe', pure=True).load(stream))
+        return schema_validators[path]
+
+    try:
+        from jsonschema.validators import extend, validator_for
+    except ImportError:  # pragma: no cover
+        raise ImportError('Schema validation requires the jsonschema package (pip install jsonschema)')
+    validator_class = validator_for(schema)
+    validator_class.check_schema(schema)
+    return extend(validator_class, type_checker=yaml_type_checker(validator_class.TYPE_CHECKER))(schema)
+
+
+def yaml_type_checker(type_checker):
+    """
+    :return: the jsonschema type_checker, extended to check the ScalarBoolean (an int subclass which ruamel.yaml
+    loads for the anchored booleans) as a boolean, and not as an integer or a number
+    """
+    def is_boolean(checker, instance):
+        return isinstance(instance, lazy.ScalarBoolean) or type_checker.is_type(instance, 'boolean')
+
+    def is_integer(checker, instance):
+        return not isinstance(instance, lazy.ScalarBoolean) and type_checker.is_type(instance, 'integer')
+
+    def is_number(checker, instance):
+        return not isinstance(instance, lazy.ScalarBoolean) and type_checker.is_type(instance, 'number')
+
+    return type_checker.redefine_many({'boolean': is_boolean, 'integer': is_integer, 'number': is_number})
+
+
+def format_path(path, root='ROOT'):
+    """
+    :param path: list of keys/indexes
+    :return: the path in the 'ROOT->a->b' format, see get_type_error()
+    """
+    return root + ''.join('->' + str(k) for k in path)
+
+
+def validate(data, schema, fail_fast=False):
+    """
+    Validate in-memory yaml data (e.g. the result of successive_merge() or normalize_docker_compose())
+    :param schema: path to a JSON schema, the schema itself, or a validator compiled by compile_schema()
+    :param fail_fast: stop at the first error
+    :raise SchemaValidationError: if data isn't valid
+    :return: data
+    """
+    validator = schema if hasattr(schema, 'iter_errors') else compile_schema(schema)
+    errors = []
+    for error in validator.iter_errors(data):
+        errors.append((format_path(error.absolute_path), error.message))
+        if fail_fast:
+            break
+    if errors:
+        raise SchemaValidationError(errors)
     return data
 
 
+##
+# SPLIT
+##
+
+def shard_of(parent, key, previous_key=MISSING):
+    """
+    :param previous_key: the key of the previous child of parent, MISSING for the first one
+    :return: a CommentedMap (or CommentedSeq) only containing parent[key], with its comments: the comments
+    preceding parent[key] are moved in front of the shard (ruamel.yaml attaches them to the previous child,
+    or to parent for the first one), but it still holds the comments following parent[key], see
+    strip_trailing_comment()
+    """
+    if isinstance(parent, lazy.CommentedMap):
+        shard = lazy.CommentedMap()
+        shard[key] = parent[key]
+        shard_key = key
+    else:
+        shard = lazy.CommentedSeq([parent[key]])
+        shard_key = 0
+    if key in parent.ca.items:
+        shard.ca.items[shard_key] = list(parent.ca.items[key])
+        if shard.ca.items[shard_key][1]:
+            shard.ca.items[shard_key][1] = dedented_comments(shard.ca.items[shard_key][1])
+    if parent.lc.data and key in parent.lc.data:
+        shard.lc.data = {shard_key: parent.lc.data[key]}  # used by split_trailing_comment()
+
+    if previous_key is MISSING:
+        preceding = list(parent.ca.comment[1] or []) if parent.ca.comment else []
+    else:
+        node, k, index = trailing_comment(parent, previous_key)
+        _, following = split_trailing_comment(node, k, index) if node is not None else (None, None)
+        preceding = following or []
+    preceding = dedented_comments(preceding)
+    while preceding and not preceding[0].value.strip():  # no blank lines at the beginning of the shard
+        preceding = preceding[1:]
+    if preceding:
+        shard.ca.comment = [None, preceding]
+    return shard
+
+
+def dedented_comments(tokens):
+    """
+    :return: the lines of the comment tokens (which can contain many lines), one token per line at the column 0
+    """
+    return [lazy.CommentToken(line.lstrip(' '), lazy.StreamMark(None, None, None, 0), None)
+            for token in tokens for line in token.value.splitlines(True)]
+
+
+def last_key(node):
+    """
+    :return: the key of the last item of a CommentedMap (not inherited through `<<`) or CommentedSeq, or MISSING
+    """
+    if isinstance(node, lazy.CommentedMap):
+        items = node.non_merged_items()
+        key = MISSING
+        for key, _ in items:
+            pass
+        return key
+    return len(node) - 1 if len(node) > 0 else MISSING
+
+
+def trailing_comment(parent, key):
+    """
+    ruamel.yaml attaches the comment following parent[key] to the last scalar (or flow collection) of parent[key],
+    in the same token as the comments preceding the next item
+    :return: (node, key, index) of this token in node.ca.items[key][index], or (None, None, None)
+    """
+    node = parent
+    while True:
+        value = node[key]
+        if not isinstance(value, (lazy.CommentedMap, lazy.CommentedSeq)) or value.fa.flow_style() or \
+                last_key(value) is MISSING:
+            break
+        node, key = value, last_key(value)
+    index = 2 if isinstance(node, lazy.CommentedMap) else 0
+    entry = node.ca.items.get(key)
+    if entry is None or entry[index] is None:
+        return None, None, None
+    return node, key, index
+
+
+def split_trailing_comment(node, key, index):
+    """
+    Split the token found by trailing_comment()
+    :return: (the end of line comment of node[key] or None, the list of the comments following it)
+    """
+    token = node.ca.items[key][index]
+    text = token.value
+    position = (node.lc.data or {}).get(key)
+    if text.lstrip(' ').startswith('#') and (position is None or token.start_mark.line is None or
+                                             token.start_mark.line == position[-2]):
+        eol, _, text = text.partition('\n')
+        eol = lazy.CommentToken(eol + '\n', token.start_mark, None)
+    else:
+        eol = None
+        if text.startswith('\n'):  # the end of the line of a (non block) scalar
+            text = text[1:]
+    following = [lazy.CommentToken(line, lazy.StreamMark(None, None, None, 0), None)
+                 for line in text.splitlines(True)]
+    return eol, following
+
+
+def strip_trailing_comment(shard):
+    """
+    Remove the comments following the child of a shard (built by shard_of()), which precede the next child.
+    The shard is modified in place, it must be a copy of the document
+    :return: shard
+    """
+    node, key, index = trailing_comment(shard, last_key(shard))
+    if node is not None:
+        eol, _ = split_trailing_comment(node, key, index)
+        node.ca.items[key][index] = eol
+    return shard
+
+
+def shard_file_name(key):
+    return str(key).replace('/', '_').replace(os.sep, '_') + '.yml'
+
+
+def default_file_mode():
+    """
+    :return: the mode of the files created by open(), i.e. 0o666 without the bits of the umask
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def atomic_dump(data, path, tools):
+    """
+    Dump data in a temporary file next to path, then rename it to path.
+    The file gets the mode of the existing path, or the default one (the temporary file is created with 0o600)
+    """
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            tools.dump(data, stream)
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = default_file_mode()
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# YamlTools instances of the worker processes, by options
+worker_tools = {}
+
+
+def dump_shard(shard, path, options):
+    """
+    Dump one shard (in a worker process), see split_yaml()
+    """
+    key = tuple(sorted(options.items()))
+    if key not in worker_tools:
+        worker_tools[key] = YamlTools(**options)
+    atomic_dump(strip_trailing_comment(shard), path, worker_tools[key])
+    return path
+
+
+def split_yaml(data, path_to_key, output_dir, workers=None, tools=None):
+    """
+    Write each child of the node at path_to_key (e.g. "services") in its own file <output_dir>/<child key>.yml,
+    with its comments. The shards are dumped in parallel by worker processes (the whole document is never dumped),
+    each file being written atomically.
+    :param path_to_key: path to a map or a sequence (see KeyPath), or an empty list for the root
+    :param workers: number of worker processes, os.cpu_count() by default, or 1 to dump the shards in this process
+    :param tools: YamlTools whose options are used to dump the shards
+    :raise ValueError: if two children would be written in the same file, or a key is empty
+    :return: the list of the written files
+    """
+    tools = tools or YamlTools()
+    path = KeyPath(path_to_key) if path_to_key else None
+    node = data
+    for k in (path.keys if path else ()):
+        node = child_item(node, k)
+        if node is MISSING:
+            break
+    if not isinstance(node, (lazy.CommentedMap, lazy.CommentedSeq)):
+        raise RuntimeError("Couldn't reach a map or a sequence following the path_to_key " + str(path))
+
+    keys = list(node.keys()) if isinstance(node, lazy.CommentedMap) else list(range(len(node)))
+    names = {}
+    for k in keys:
+        name = shard_file_name(k)
+        if name == '.yml':
+            raise ValueError("the key \'{}\' can\'t be used as a file name".format(k))
+        if os.path.normcase(name) in names:
+            raise ValueError("the keys \'{}\' and \'{}\' are both written in the file {}".format(
+                names[os.path.normcase(name)], k, name))
+        names[os.path.normcase(name)] = k
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    paths = [os.path.join(output_dir, shard_file_name(k)) for k in keys]
+    previous_keys = [MISSING] + keys[:-1]
+    if workers == 1:
+        for k, previous_k, shard_path in zip(keys, previous_keys, paths):
+            shard = lazy.deepcopy(shard_of(node, k, previous_k))
+            atomic_dump(strip_trailing_comment(shard), shard_path, tools)
+        return paths
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # the shards are copied to the worker processes
+        futures = [executor.submit(dump_shard, shard_of(node, k, previous_k), shard_path, tools.options)
+                   for k, previous_k, shard_path in zip(keys, previous_keys, paths)]
+        return [f.result() for f in futures]
+
+
+##
+# LIBRARY API
+##
+
+class YamlTools(object):
+    """
+    In-process API: holds configured round-trip YAML() instances which are reused across calls,
+    instead of building a new loader/dumper on each call like round_trip_load/round_trip_dump do.
+    An instance is not thread-safe, use one instance per thread.
+
+    Every `source` argument can be a path (str or os.PathLike), yaml content (bytes), a readable stream,
+    or already loaded yaml data (CommentedMap or CommentedSeq). A str is always a path, the yaml text in a str
+    must be encoded, loaded with load(text=...) or passed as a stream (e.g. io.StringIO).
+    """
+
+    def __init__(self, indent=None, width=None, preserve_quotes=True):
+        """
+        :param indent: mapping indentation (int), or (mapping, sequence, offset) indentations
+        :param width: best width of the output lines
+        :param preserve_quotes: keep the quotes of the scalars as they were in the input
+        """
+        self.options = {'indent': indent, 'width': width, 'preserve_quotes': preserve_quotes}
+        self.yaml = lazy.YAML(typ='rt')
+        self.yaml.preserve_quotes = preserve_quotes
+        if isinstance(indent, int):
+            self.yaml.indent(mapping=indent)
+        elif indent is not None:
+            self.yaml.indent(*indent)
+        if width is not None:
+            self.yaml.width = width
+
+    def load(self, source=None, text=None):
+        """
+        :param source: path, yaml content (bytes), stream or loaded yaml data, see YamlTools
+        :param text: yaml content (str or bytes), instead of source
+        :return: the loaded yaml data (or source itself if it's already loaded yaml data)
+        """
+        if text is not None:
+            return self.yaml.load(text)
+        if isinstance(source, (lazy.CommentedMap, lazy.CommentedSeq)):
+            return source
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'r') as stream:
+                return self.yaml.load(stream)
+        if isinstance(source, bytes) or hasattr(source, 'read'):
+            return self.yaml.load(source)
+        raise TypeError('Expected a path, yaml content (bytes), a stream or loaded yaml data, got a {0}'.format(
+            type(source)))
+
+    def merge(self, *sources, rules=None, anchors=False):
+        """
+        Merge two or more sources, from the last to the first, see successive_merge()
+        :param rules: optional MergeRules
+        :param anchors: anchor-aware merge, see SharedNodes
+        """
+        return successive_merge_data([self.load(s) for s in sources], rules, anchors)
+
+    def delete(self, source, path_to_key, data_contains_list=True):
+        """
+        Delete a yaml item given its path_to_key, see delete_yaml_item()
+        """
+        data, _ = delete_yaml_item(self.load(source), path_to_key, data_contains_list)
+        return data
+
+    def comment(self, source, path_to_key, data_contains_list=True):
+        """
+        (EXPERIMENTAL) Comment a yaml item given its path_to_key, see comment_yaml_item()
+        """
+        return comment_yaml_item(self.load(source), path_to_key, data_contains_list, yaml=self.yaml)
+
+    def normalize(self, source, anchors=False):
+        """
+        Normalize a docker-compose source, see normalize_docker_compose()
+        :param anchors: anchor-aware normalization, see normalize_service()
+        """
+        return normalize_docker_compose_data(self.load(source), anchors)
+
+    def streaming_merge(self, sources, output, paths, rules=None, anchors=False,
+                        memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        Merge the sources and write the result in output, streaming the sequences at the given paths,
+        see streaming_merge()
+        """
+        streaming_merge(sources, output, paths, rules, anchors, memory_budget, self)
+
+    def validate(self, data, schema, fail_fast=False):
+        """
+        Validate loaded yaml data against a JSON schema, see validate()
+        """
+        return validate(data, schema, fail_fast)
+
+    def split(self, data, path_to_key, output_dir, workers=None):
+        """
+        Write each child of the node at path_to_key in its own file, see split_yaml()
+        """
+        return split_yaml(data, path_to_key, output_dir, workers, self)
+
+    def dump(self, data, output=None):
+        """
+        :param output: path (str or os.PathLike) or stream, or None to return the dumped yaml as a str
+        """
+        if output is None:
+            stream = lazy.StringIO()
+            self.yaml.dump(data, stream)
+            return stream.getvalue()
+        if isinstance(output, (str, os.PathLike)):
+            with open(output, 'w') as stream:
+                self.yaml.dump(data, stream)
+        else:
+            self.yaml.dump(data, output)
+
+
 ###
 # main and commands
 ###
 
-def main():
+def main(argv=None):
+    """
+    :param argv: command line arguments (without the program name), sys.argv[1:] by default
+    """
+    if argv is None:
+        argv = sys.argv[1:]
     parser = argparse.ArgumentParser(
         description='A set of CLI tools to manipulate YAML files (merge, delete, comment, etc...) \
          with comment preservation',
         usage='''yaml-tools <command> [<args>]
-At the moment there are three commands available:
-   merge     Merge two or more yaml files and preserve the comments
-   delete    Delete an item (and all its child items) given its path from the input yaml file
-   comment   Comment an item (and all its child items) given its path from the input yaml file''')
+At the moment there are four commands available:
+   merge                      Merge two or more yaml files and preserve the comments
+   delete                     Delete an item (and all its child items) given its path from the input yaml file
+   comment                    Comment an item (and all its child items) given its path from the input yaml file
+   normalize-docker-compose   Normalize the input docker-compose file''')
     parser.add_argument('command', help='Sub-command to run')
     # parse_args defaults to [1:] for args, but you need to
     # exclude the rest of the args too, or validation will fail
-    args = parser.parse_args(sys.argv[1:2])
-    if args.command == 'merge':
-        merge_command()
-    elif args.command == 'delete':
-        delete_command()
-    elif args.command == 'comment':
-        comment_command()
-    elif args.command == 'normalize-docker-compose':
-        normalize_docker_compose_command()
-    else:
+    args = parser.parse_args(argv[0:1])
+    command = COMMANDS.get(args.command)
+    if command is None:
         print('Unrecognized command')
         parser.print_help()
         exit(1)
+    command(argv[1:])
 
 
-def merge_command():
+def merge_command(argv):
     """
     Sub-command, see main()
     """
@@ -373,8 +1516,30 @@ def merge_command():
                         required=True)
     parser.add_argument('-o', '--output', type=str,
                         help='Path to the output file, or stdout by default')
-
-    args = parser.parse_args(sys.argv[2:])
+    parser.add_argument('-s', '--strategy', nargs=2, action='append', metavar=('PATH', 'STRATEGY'),
+                        help='Merge strategy for the items at PATH (e.g. "services * ports"), one of: '
+                             'deep-merge, replace, append, unique-append, merge-by-key:KEY')
+    parser.add_argument('-a', '--anchors', action='store_true',
+                        help='Anchor-aware merge: keep the anchors/aliases and `<<` merge keys shared')
+    parser.add_argument('--stream', type=str, action='append', metavar='PATH',
+                        help='Stream the merged sequence at PATH (e.g. "hosts"), spilling its items to disk '
+                             'instead of building it in memory')
+    parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET, metavar='BYTES',
+                        help='Memory budget of each streamed sequence before it spills to disk')
+    add_schema_arguments(parser)
+    add_split_arguments(parser)
+
+    args = parser.parse_args(argv)
+    if args.stream and args.schema:
+        parser.error('--schema can\'t be used with --stream, the streamed sequences are never in memory')
+    if args.stream and args.split_by is not None:
+        parser.error('--split-by can\'t be used with --stream')
+    check_split_arguments(parser, args)
+    rules = MergeRules(args.strategy) if args.strategy else None
+
+    if args.stream:
+        streaming_merge(args.inputs, args.output or sys.stdout, args.stream, rules, args.anchors, args.memory_budget)
+        return
 
     file_contents = []
     for f in args.inputs:
@@ -382,13 +1547,17 @@ def merge_command():
         file_contents.append(file.read())
         file.close()
 
-    out_content = successive_merge(file_contents)
+    out_content = successive_merge(file_contents, rules, args.anchors)
+    validate_command_output(out_content, args)
+    if args.split_by is not None:
+        split_yaml(out_content, args.split_by, args.output, args.workers)
+        return
     output_file = open(args.output, 'w') if args.output else sys.stdout
-    round_trip_dump(out_content, output_file)
+    lazy.round_trip_dump(out_content, output_file)
     output_file.close()
 
 
-def delete_command():
+def delete_command(argv):
     """
     Sub-command, see main()
     """
@@ -401,19 +1570,19 @@ def delete_command():
     parser.add_argument('-o', '--output', type=str,
                         help='Path to the output file, or stdout by default')
 
-    args = parser.parse_args(sys.argv[2:])
+    args = parser.parse_args(argv)
     input_file = open(args.input, 'r')
-    data = round_trip_load(input_file.read(), preserve_quotes=True)
+    data = lazy.round_trip_load(input_file.read(), preserve_quotes=True)
     input_file.close()
 
     output_data, _ = delete_yaml_item(data, args.path_to_key, True)
 
     output_file = open(args.output, 'w') if args.output else sys.stdout
-    round_trip_dump(output_data, output_file)
+    lazy.round_trip_dump(output_data, output_file)
     output_file.close()
 
 
-def comment_command():  # pragma: no cover
+def comment_command(argv):  # pragma: no cover
     """
     Sub-command, see main()
     """
@@ -427,19 +1596,19 @@ def comment_command():  # pragma: no cover
     parser.add_argument('-o', '--output', type=str,
                         help='Path to the output file, or stdout by default')
 
-    args = parser.parse_args(sys.argv[2:])
+    args = parser.parse_args(argv)
     input_file = open(args.input, 'r')
-    data = round_trip_load(input_file.read(), preserve_quotes=True)
+    data = lazy.round_trip_load(input_file.read(), preserve_quotes=True)
     input_file.close()
 
     output_data = comment_yaml_item(data, args.path_to_key, True)
 
     output_file = open(args.output, 'w') if args.output else sys.stdout
-    round_trip_dump(output_data, output_file)
+    lazy.round_trip_dump(output_data, output_file)
     output_file.close()
 
 
-def normalize_docker_compose_command():
+def normalize_docker_compose_command(argv):
     """
     Sub-command, see main()
     """
@@ -449,18 +1618,66 @@ def normalize_docker_compose_command():
                         help='<Required> Path to the input yaml file', required=True)
     parser.add_argument('-o', '--output', type=str,
                         help='Path to the output file, or stdout by default')
+    parser.add_argument('-a', '--anchors', action='store_true',
+                        help='Anchor-aware normalization: keep the anchors/aliases and `<<` merge keys shared')
+    add_schema_arguments(parser)
+    add_split_arguments(parser)
 
-    args = parser.parse_args(sys.argv[2:])
+    args = parser.parse_args(argv)
+    check_split_arguments(parser, args)
     input_file = open(args.input, 'r')
     content = input_file.read()
     input_file.close()
 
-    output_data = normalize_docker_compose(content)
+    output_data = normalize_docker_compose(content, args.anchors)
+    validate_command_output(output_data, args)
+    if args.split_by is not None:
+        split_yaml(output_data, args.split_by, args.output, args.workers)
+        return
 
     output_file = open(args.output, 'w') if args.output else sys.stdout
-    round_trip_dump(output_data, output_file)
+    lazy.round_trip_dump(output_data, output_file)
     output_file.close()
 
 
+def add_schema_arguments(parser):
+    parser.add_argument('--schema', type=str,
+                        help='Path to a JSON schema (json or yaml) the output is validated against before being written')
+    parser.add_argument('--fail-fast', action='store_true',
+                        help='Stop the schema validation at the first error')
+
+
+def validate_command_output(data, args):
+    """
+    Validate the output of a sub-command if --schema is given, print the errors and exit otherwise
+    """
+    if args.schema:
+        try:
+            validate(data, args.schema, args.fail_fast)
+        except SchemaValidationError as e:
+            print(str(e), file=sys.stderr)
+            exit(1)
+
+
+def add_split_arguments(parser):
+    parser.add_argument('--split-by', type=str, metavar='PATH',
+                        help='Write each child of the item at PATH (e.g. "services", or "" for the root) in its own '
+                             'file in the OUTPUT directory')
+    parser.add_argument('--workers', type=int,
+                        help='Number of worker processes dumping the split files, the number of CPUs by default')
+
+
+def check_split_arguments(parser, args):
+    if args.split_by is not None and not args.output:
+        parser.error('--split-by requires -o OUTPUT, the output directory')
+
+
+COMMANDS = {
+    'merge': merge_command,
+    'delete': delete_command,
+    'comment': comment_command,
+    'normalize-docker-compose': normalize_docker_compose_command,
+}
+
 if __name__ == '__main__':  # pragma: no cover
     main()